@@ -0,0 +1,17 @@
+select 
+    l.id
+    ,l.estimate
+    ,e.created_at estimate_date
+    ,l.quantity
+    ,l.uom
+    ,l.total_uc
+    ,(l.uf ->> 'uf1') uf1_code
+    ,(l.uf ->> 'uf2') uf2_code
+    ,(l.uf ->> 'uf3') uf3_code
+    ,(l.mf ->> 'mf1') mf1_code
+    ,(l.mf ->> 'mf2') mf2_code
+    ,(l.mf ->> 'mf3') mf3_code
+from line_items l
+join estimates e
+on e.id = l.estimate
+where l.estimate in (__ESTIMATE_IDS__)
\ No newline at end of file
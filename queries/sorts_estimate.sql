@@ -5,6 +5,7 @@ with cte_extras as (
 		,extras ->> jsonb_object_keys(t.extras) sc_keys
 	from line_items t
 	where estimate = '__ESTIMATE_ID__'
+__FILTER__
 )
 select 
 	e.id
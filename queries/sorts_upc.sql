@@ -4,6 +4,7 @@ with cte_extras as (
 		,jsonb_object_keys(t.extras) sf_keys
 		,extras ->> jsonb_object_keys(t.extras) sc_keys
 	from products t
+__FILTER__
 )	
 select 
 	e.id
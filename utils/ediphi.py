@@ -1,8 +1,15 @@
 import os
+import re
+import bisect
+import copy
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
 from dotenv import load_dotenv
 import requests
 from json.decoder import JSONDecodeError
 import json
+import numpy as np
 import pandas as pd
 from tenacity import retry, wait_fixed, wait_random, stop_after_attempt
 
@@ -15,6 +22,144 @@ def main():
     print(line_items.head())
 
 
+# -----------------------------------------------------------------------
+# SQL helpers
+
+
+def _normalize_sql(query):
+    """
+    Private function to collapse whitespace outside string literals and drop trailing semicolons in a sql string
+    """
+
+    query = re.sub(
+        r"('(?:[^']|'')*')|\s+", lambda m: m.group(1) or " ", query.strip()
+    )
+    return query.rstrip(";").strip()
+
+
+def _fingerprint_sql(query):
+    """
+    Private function to reduce a sql string to its template, so that queries differing only by literals group together
+    """
+
+    query = _normalize_sql(query).lower()
+    query = re.sub(r"'(?:[^']|'')*'", "?", query)
+    query = re.sub(r"\b\d+(?:\.\d+)?\b", "?", query)
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", query)
+
+
+def _tokenize(text):
+    """
+    Private function to split a name into lowercase alphanumeric tokens for searching
+    """
+
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+
+def _unpack_csi_json(schema, levels):
+    """
+    Private function to build the sql that unpacks csi codes and descriptions for a schema from the setup table
+    """
+
+    root = "jsonb_array_elements(value)"
+    elems = []
+    for level in levels:
+        if level == 1:
+            elem = root
+        else:
+            elem = (
+                "jsonb_array_elements(" * (level - 1)
+                + root
+                + " ->'children')" * (level - 1)
+            )
+        elems.append(f"{elem} ->> 'code' {schema}{level}_code")
+        elems.append(f"{elem} ->> 'description' {schema}{level}_desc")
+    return (
+        "select\n   "
+        + "".join(map(lambda x: f"{x}\n  ,", elems[:-1]))
+        + elems[-1]
+        + f"\nfrom setup s\nwhere key = 'sort_codes:{schema}'"
+    )
+
+
+def _check_csi_args(schemas, levels):
+    """
+    Private function to validate the schemas and levels arguments used to describe csi sorts
+    """
+
+    if any([i not in ["mf", "uf"] for i in schemas]) or (type(schemas) != list):
+        raise ValueError("Schema must be type list, and may contain mf, uf, or both")
+    if all([(type(levels) != list), levels is not None]):
+        raise ValueError("Levels must be type list (or None to use all levels)")
+
+
+def _merge_csi(df, df_csi, schema, levels):
+    """
+    Private function to merge csi descriptions for a schema onto lines, placing each description after its code
+    """
+
+    cols = list(df.columns)
+    for n in levels:
+        df_csi_l = df_csi[[f"{schema}{n}_code", f"{schema}{n}_desc"]].drop_duplicates()
+        df = df.merge(df_csi_l, on=f"{schema}{n}_code", how="left")
+        idx = cols.index(f"{schema}{n}_code")
+        cols.insert(idx + 1, f"{schema}{n}_desc")
+    return df[cols]
+
+
+def _merge_custom_sorts(df, df_cs, sorts):
+    """
+    Private function to merge custom sort codes and descriptions onto lines by id
+    """
+
+    cols = list(df.columns)
+    for sort in sorts:
+        df_cs_l = df_cs.loc[
+            df_cs["code_name"] == sort, ["id", "code", "description"]
+        ].drop_duplicates()
+        df_cs_l.columns = ["id", f"{sort}_code", f"{sort}_desc"]
+        df = df.merge(df_cs_l, on="id", how="left")
+        cols += [f"{sort}_code", f"{sort}_desc"]
+    return df[cols]
+
+
+# in-flight requests shared by concurrent callers, keyed by database and sql; each entry is [future, followers]
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _single_flight(key, fn, share=None):
+    """
+    Private function to share one call of fn, and its result or exception, among concurrent callers using the same key
+
+        When the call was shared, every caller receives share(result), so no two callers hold the same objects
+    """
+
+    with _inflight_lock:
+        entry = _inflight.get(key)
+        leader = entry is None
+        if leader:
+            entry = _inflight[key] = [Future(), 0]
+        else:
+            entry[1] += 1
+    future = entry[0]
+    if not leader:
+        result = future.result()
+        return result if share is None else share(result)
+    try:
+        result = fn()
+    except BaseException as e:
+        with _inflight_lock:
+            del _inflight[key]
+        future.set_exception(e)
+        raise
+    with _inflight_lock:
+        del _inflight[key]
+        shared = entry[1] > 0
+    future.set_result(result)
+    return share(result) if (shared and share is not None) else result
+
+
 # -----------------------------------------------------------------------
 # Database class
 
@@ -34,6 +179,12 @@ class Database:
     tanant_name : string
     tables : dict
         keys are table_name, values are table_id
+    profiling : bool
+        True while query profiling is enabled, see enable_profiling
+    profile_threshold : float
+        seconds a query may run before its plan is captured
+    profile_log : list
+        one record per query executed while profiling
     """
 
     def __init__(self):
@@ -41,16 +192,24 @@ class Database:
         self.describe = self._describe_db()
         self.tenant_name = self.describe["name"]
         self.tables = {i["name"]: i["id"] for i in self.describe["tables"]}
+        self.profiling = False
+        self.profile_threshold = 1.0
+        self.profile_log = []
+        self._profile_lock = threading.Lock()
 
     def _describe_db(self):
         """
         Private method for Database to describe itself to itself
         """
 
-        url = f'https://data.ediphi.com/api/database/{os.getenv("DATABASE_NO")}?include=tables'
-        headers = {"X-API-KEY": os.getenv("X_API_KEY")}
-        response = requests.request("GET", url, headers=headers)
-        return json.loads(response.content)
+        def describe():
+            url = f'https://data.ediphi.com/api/database/{os.getenv("DATABASE_NO")}?include=tables'
+            headers = {"X-API-KEY": os.getenv("X_API_KEY")}
+            response = requests.request("GET", url, headers=headers)
+            return json.loads(response.content)
+
+        key = ("describe", os.getenv("DATABASE_NO"))
+        return copy.deepcopy(_single_flight(key, describe))
 
     @retry(wait=wait_fixed(3) + wait_random(0, 2), stop=stop_after_attempt(5))
     def query(self, query: str, df: bool = False):
@@ -63,7 +222,12 @@ class Database:
         Query responses can fetch as many as 200_000 rows,
         unless query duration causes it to run past changes made on the primary.
         Therefore, setting limit to a lower value and iterating result sets is advised.
-        Try fetching 1000 rows at a time
+        Try fetching 1000 rows at a time, or use the export method for large results
+
+        Queries are safe to run from several threads at once. Concurrent calls issuing the same sql
+        (ignoring leading and trailing whitespace and semicolons) against the same database share one request.
+        When a request is shared, each caller receives its own deep copy of the rows; otherwise no copy is made.
+        While profiling, only the call that sent the request is timed and explained.
 
         Parameters
         ----------
@@ -87,7 +251,43 @@ class Database:
         [{'name': 'Test Project AB'}]
         """
 
+        def post():
+            start = time.perf_counter()
+            result = self._post_query(query)
+            if self.profiling:
+                self._profile_query(query, time.perf_counter() - start)
+            return result
+
+        key = ("query", os.getenv("DATABASE_NO"), query.strip().rstrip(";"))
+        result = _single_flight(key, post, share=copy.deepcopy)
+        if df:
+            return pd.DataFrame(result)
+        else:
+            return result
+
+    def _post_query(self, query: str):
+        """
+        Private method for Database to send sql to the dataset endpoint and unpack the response
+        """
+
         url = "https://data.ediphi.com/api/dataset/json"
+        try:
+            response = requests.post(url, **self._dataset_request(query))
+            result = json.loads(response.content)
+            error = result["error"]
+            raise ValueError(error)
+        except TypeError:
+            return result
+        except JSONDecodeError as j:
+            raise ValueError(
+                f"result size exceeds connection limit, try the export method:\n  {j.msg}"
+            )
+
+    def _dataset_request(self, query: str):
+        """
+        Private method for Database to build the headers and form data that the dataset endpoints expect
+        """
+
         headers = {
             "Content-Type": "application/x-www-form-urlencoded",
             "X-API-KEY": os.getenv("X_API_KEY"),
@@ -101,18 +301,205 @@ class Database:
                 }
             )
         }
-        try:
-            response = requests.post(url, headers=headers, data=data)
-            result = json.loads(response.content)
-            error = result["error"]
+        return {"headers": headers, "data": data}
+
+    @retry(wait=wait_fixed(3) + wait_random(0, 2), stop=stop_after_attempt(5))
+    def export(
+        self, query: str, path: str = None, chunksize: int = None, dtype: dict = None
+    ):
+        """
+        Method to execute sql through the csv export endpoint, streaming the response instead of loading it whole.
+
+        Note
+        ----------
+        The query method receives every row as a json object in one response body, which limits the size of a result.
+        The csv export carries each column name once and is parsed, or written to disk, as it arrives,
+        so one request can return far more rows than query. The same read-replica caveats apply to long queries.
+
+        Parameters
+        ----------
+        query : string
+            must be valid sql
+        path : string, default: None
+            Set to a file path to write the csv there instead of parsing it
+        chunksize : int, default: None
+            Set to return a generator of dataframes of this many rows, parsed as the response arrives.
+            The response stays open until the generator is exhausted, so consume it, or call its close method
+            when stopping early. A profiled export is recorded once the last chunk has been read.
+        dtype : dict, default: None
+            Column types passed to pandas.read_csv; e.g. {'quantity': 'float64', 'uom': 'category'}
+
+        Returns
+        -------
+        dataframe | generator of dataframes | string - the path written to
+
+        Examples
+        --------
+        Export every line item of the database in one request.
+
+        >>> tenant = ediphi.Database()
+        >>> df = tenant.export('select id, estimate, quantity, uom, total_uc from line_items', dtype={'uom': 'category'})
+        >>> df.shape
+           (1254310, 5)
+        """
+
+        url = "https://data.ediphi.com/api/dataset/csv"
+        request = self._dataset_request(query)
+        request["data"]["format_rows"] = "false"
+        start = time.perf_counter()
+        response = requests.post(url, stream=True, **request)
+        content_type = response.headers.get("Content-Type", "")
+        if (response.status_code != 200) or ("json" in content_type):
+            try:
+                error = json.loads(response.content).get("error", response.text)
+            except (JSONDecodeError, AttributeError):
+                error = response.text
+            response.close()
             raise ValueError(error)
-        except TypeError:
-            if df:
-                return pd.DataFrame(result)
-            else:
-                return result
-        except JSONDecodeError as j:
-            raise ValueError(f"result size exceeds connection limit:\n  {j.msg}")
+        response.raw.decode_content = True
+        if path:
+            with response, open(path, "wb") as f:
+                for block in response.iter_content(chunk_size=1 << 20):
+                    f.write(block)
+            result = path
+        elif chunksize:
+
+            def chunks():
+                try:
+                    reader = pd.read_csv(response.raw, chunksize=chunksize, dtype=dtype)
+                    yield
+                    with reader:
+                        yield from reader
+                    if self.profiling:
+                        self._profile_query(query, time.perf_counter() - start)
+                finally:
+                    response.close()
+
+            generator = chunks()
+            next(generator)
+            return generator
+        else:
+            with response:
+                result = pd.read_csv(response.raw, dtype=dtype)
+        if self.profiling:
+            self._profile_query(query, time.perf_counter() - start)
+        return result
+
+    def _profile_query(self, query: str, elapsed: float):
+        """
+        Private method for Database to record a profiled query, capturing its plan when it runs past profile_threshold
+        """
+
+        record = {
+            "fingerprint": _fingerprint_sql(query),
+            "query": query.strip().rstrip(";"),
+            "elapsed": elapsed,
+            "plan_elapsed": None,
+            "total_cost": None,
+            "plan": None,
+            "plan_error": None,
+        }
+        if elapsed >= self.profile_threshold:
+            start = time.perf_counter()
+            try:
+                explain = f"explain (format json) {query.strip().rstrip(';')}"
+                key = ("query", os.getenv("DATABASE_NO"), explain)
+                res = _single_flight(key, lambda: self._post_query(explain))
+                plan = next(iter(res[0].values()))
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                record["plan"] = plan
+                record["total_cost"] = plan[0]["Plan"]["Total Cost"]
+            except (ValueError, KeyError, IndexError, TypeError, StopIteration) as e:
+                record["plan_error"] = str(e)
+            record["plan_elapsed"] = time.perf_counter() - start
+        with self._profile_lock:
+            self.profile_log.append(record)
+
+    def enable_profiling(self, threshold: float = 1.0):
+        """
+        Method to start profiling queries executed through the query method
+
+            Every query is timed on the client. Any query running for at least threshold seconds is re-run
+            through the same endpoint as explain (format json), and its plan is stored next to the timing in profile_log
+
+        Parameters
+        ----------
+        threshold : float, default: 1.0
+            Seconds a query may run before its plan is captured. Set to 0 to capture every plan
+
+        Examples
+        --------
+        Profile the queries behind an estimate expansion.
+
+        >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
+        >>> est.enable_profiling(threshold=0.5)
+        >>> df = est.expand_estimate_lines()
+        >>> est.disable_profiling()
+        >>> display(est.profile_report(df=True))
+        """
+
+        self.profile_threshold = threshold
+        self.profiling = True
+
+    def disable_profiling(self):
+        """
+        Method to stop profiling queries. Records already in profile_log are kept
+        """
+
+        self.profiling = False
+
+    def profile_report(self, df: bool = False):
+        """
+        Method to summarize profile_log by query fingerprint
+
+            Queries that differ only by their literals (ids, limits, codes) share a fingerprint.
+            Fingerprints are ranked by total client time, then by the highest plan cost captured for them
+
+        Parameters
+        ----------
+        df : bool, default: False
+            Set to True to return results as pandas dataframe
+
+        Returns
+        -------
+        dict | dataframe
+            one row per fingerprint with calls, total_time, mean_time, max_time, explained, max_cost and a sample query
+        """
+
+        cols = [
+            "fingerprint",
+            "calls",
+            "total_time",
+            "mean_time",
+            "max_time",
+            "explained",
+            "max_cost",
+            "query",
+        ]
+        with self._profile_lock:
+            log = pd.DataFrame(self.profile_log)
+        if log.empty:
+            report = pd.DataFrame(columns=cols)
+        else:
+            report = (
+                log.groupby("fingerprint", sort=False)
+                .agg(
+                    calls=("elapsed", "size"),
+                    total_time=("elapsed", "sum"),
+                    mean_time=("elapsed", "mean"),
+                    max_time=("elapsed", "max"),
+                    explained=("total_cost", "count"),
+                    max_cost=("total_cost", "max"),
+                    query=("query", "first"),
+                )
+                .reset_index()
+                .sort_values(["total_time", "max_cost"], ascending=False)
+                .reset_index(drop=True)[cols]
+            )
+        if df:
+            return report
+        else:
+            return report.to_dict("records")
 
     def data_dictionary(self, table_name: str = None, df=False):
         """
@@ -261,120 +648,511 @@ class Database:
 
 
 # -----------------------------------------------------------------------
-# Estimate class
+# Star schema classes
 
 
-class Estimate(Database):
+class Dimensions:
     """
-    Estimate instance for a Database.
+    Shared dimension tables for csi levels and custom sorts.
 
-    Data structure also includes estimate lines, and uf and mf levels
+    Each dimension is a dataframe of unique code and desc pairs, indexed by the integer key that StarLines stores in place of the code.
+    Pass the same Dimensions to several estimates (or to an estimate and the UPC) so that every code and description is held once.
 
-    Parameters
+    Attributes
     ----------
-    estimate_id : string
+    tables : dict
+        keys are dimension names (e.g. uf3, Bid Package), values are dataframes with code and desc columns
 
-        Must exist in Database.
+    Examples
+    --------
+    Sharing dimension tables between two estimates.
+
+    >>> dims = ediphi.Dimensions()
+    >>> est_a = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
+    >>> est_b = ediphi.Estimate(estimate_id='e794ad3a-f747-4409-a373-15be7b8f0be9')
+    >>> star_a = est_a.star_estimate_lines(dimensions=dims)
+    >>> star_b = est_b.star_estimate_lines(dimensions=dims)
+    >>> display(dims.tables['uf3'].head(3))
+    +----+--------+------------------------+
+    |    | code   | desc                   |
+    |----+--------+------------------------|
+    |  0 | A1010  | Standard Foundations   |
+    |  1 | A1020  | Special Foundations    |
+    |  2 | A1030  | Slab on Grade          |
+    +----+--------+------------------------+
+    """
 
-    add_cols : list, default: []
+    def __init__(self):
+        self.tables = {}
+        self._lookups = {}
+        self._lock = threading.Lock()
 
-        Additional columns to return from the line_items table.
+    def __getstate__(self):
+        return {"tables": self.tables}
+
+    def __setstate__(self, state):
+        self.tables = state["tables"]
+        self._lookups = {}
+        self._lock = threading.Lock()
+
+    def load_csi(self, db, schema, levels):
+        """
+        Method to load csi dimension tables for a schema from the setup table, skipping levels that are already loaded
+
+        Parameters
+        ----------
+        db : Database
+            used to execute the query
+        schema : string
+            Must be either 'mf' or 'uf'
+        levels : list of integers
+        """
+
+        levels = [n for n in levels if f"{schema}{n}" not in self.tables]
+        if levels:
+            df_csi = db.query(query=_unpack_csi_json(schema, levels), df=True)
+            for n in levels:
+                self.encode(
+                    f"{schema}{n}", df_csi[f"{schema}{n}_code"], df_csi[f"{schema}{n}_desc"]
+                )
+
+    def encode(self, name, codes, descs=None):
+        """
+        Method to translate codes into integer keys for a dimension, appending any rows it has not seen yet
+
+            Rows are unique on code and description, so a code described differently by two sources gets two keys,
+            and sharing a dimension never changes the description a line resolves to
+
+        Parameters
+        ----------
+        name : string
+            dimension name, created if it does not exist
+        codes : list-like
+        descs : list-like, default: None
+            descriptions aligned with codes. Otherwise, each code resolves to the first row with that code,
+            as for line codes matched against csi dimensions loaded from the setup table
+
+        Returns
+        -------
+        numpy array of int32 keys, -1 where the code is null
+        """
+
+        rows = pd.DataFrame(
+            {
+                "code": pd.Series(codes).reset_index(drop=True),
+                "desc": None if descs is None else pd.Series(descs).reset_index(drop=True),
+            }
+        )
+        on = ["code"] if descs is None else ["code", "desc"]
+        inverse = rows.groupby(on, dropna=False, sort=False).ngroup().to_numpy()
+        rows = rows.drop_duplicates(on)
+        with self._lock:
+            dim = self.tables.get(name, pd.DataFrame(columns=["code", "desc"]))
+            if name not in self._lookups:
+                self._lookups[name] = self._build_lookups(dim)
+            by_pair, by_code = self._lookups[name]
+            new, uniq_keys = [], []
+            for code, desc in zip(rows["code"], rows["desc"]):
+                if pd.isna(code):
+                    uniq_keys.append(-1)
+                    continue
+                desc = None if pd.isna(desc) else desc
+                key = by_code.get(code) if descs is None else by_pair.get((code, desc))
+                if key is None:
+                    key = len(dim) + len(new)
+                    new.append((code, desc))
+                    by_pair.setdefault((code, desc), key)
+                    by_code.setdefault(code, key)
+                uniq_keys.append(key)
+            if new or name not in self.tables:
+                new = pd.DataFrame(new, columns=["code", "desc"])
+                self.tables[name] = pd.concat([dim, new], ignore_index=True)
+        return np.asarray(uniq_keys, dtype="int32")[inverse]
+
+    @staticmethod
+    def _build_lookups(dim):
+        """
+        Private method for Dimensions to index a dimension table by code and description, and by code alone (first row wins)
+        """
+
+        by_pair, by_code = {}, {}
+        for key, (code, desc) in enumerate(zip(dim["code"], dim["desc"])):
+            desc = None if pd.isna(desc) else desc
+            by_pair.setdefault((code, desc), key)
+            by_code.setdefault(code, key)
+        return by_pair, by_code
+
+    def decode(self, name, keys, column="code"):
+        """
+        Method to translate integer keys back into codes or descriptions for a dimension
+
+        Parameters
+        ----------
+        name : string
+            must exist in tables
+        keys : list-like of integers
+        column : string, default: 'code'
+            Must be either 'code' or 'desc'
+
+        Returns
+        -------
+        numpy array, null where the key is -1
+        """
+
+        return self.tables[name][column].reindex(keys).to_numpy()
+
+
+class StarLines:
+    """
+    Star-schema representation of expanded lines.
+
+    Holds a narrow fact frame of line measures and integer keys, and the shared Dimensions those keys point into.
+    The wide view produced by expand_estimate_lines and expand_upc_lines is only built when asked, either whole or per column.
 
     Attributes
     ----------
-    estimate_id : string (uuid)
-    add_cols : list, default: []
-    estimate_name : string
-    lines : dataframe of the base columns from the line_items table
-    expanded_lines : dataframe from the line_items table including expanded sorts resulting from the expand_estimate_lines method
-    uf_levels : list of integers - uniformat levels that exist within the estimate
-    mf_levels : list of integers - masterformat levels that exist within the estimate
+    facts : dataframe - one row per line, with the base columns and a <dimension>_key column in place of each expanded code
+    dimensions : Dimensions - shared dimension tables the keys point into
+    keys : dict - keys are wide column prefixes (e.g. uf3, Bid Package), values are dimension names
+    columns : list - column order of the wide view
 
     Examples
     --------
-    Instatiating an estimate and inspecting its uf_levels.
+    Materializing a single column, then the wide view.
 
     >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
-    >>> display(est.uf_levels)
-       {1, 2, 3, 4}
+    >>> star = est.star_estimate_lines(schemas=['uf',], levels=[3,], sorts=['Bid Package',])
+    >>> star.column('uf3_desc').head(2)
+    0    Floor Construction
+    1        Exterior Walls
+    Name: uf3_desc, dtype: object
+    >>> df = star.materialize()
     """
 
-    def __init__(self, estimate_id, add_cols=[]):
-        super().__init__()
-        self.estimate_id = estimate_id
-        self.add_cols = add_cols
-        self.estimate_name = self.query(
-            f"select name from estimates where id = '{self.estimate_id}'"
-        )[0]["name"]
-        self.lines = self._get_lines()
-        self.expanded_lines = None
-        self.uf_levels = self._get_csi_levels("uf")
-        self.mf_levels = self._get_csi_levels("mf")
+    def __init__(self, facts, dimensions, keys, columns):
+        self.facts = facts
+        self.dimensions = dimensions
+        self.keys = keys
+        self.columns = columns
 
-    def _get_lines(self):
-        """
-        Private method for estimate to get its own lines
+    def column(self, name):
         """
+        Method to materialize one column of the wide view
 
-        update = {
-            "__ADD_COLS__": "\n".join(map(lambda x: f"    ,{x}", self.add_cols)),
-            "__ESTIMATE_ID__": self.estimate_id,
-        }
-        with open("./queries/base_estimate_lines.sql", "r") as q:
-            query = q.read()
-            for i, j in update.items():
-                query = query.replace(i, j)
-        df = self.query(query=query, df=True)
-        cols = [
-            "id",
-            "name",
-            "quantity",
-            "uom",
-            "total_uc",
-            "mf1_code",
-            "mf2_code",
-            "mf3_code",
-            "uf1_code",
-            "uf2_code",
-            "uf3_code",
-        ] + self.add_cols
-        return df[cols]
+        Parameters
+        ----------
+        name : string
+            a base column, or <prefix>_code / <prefix>_desc for an expanded sort
 
-    def _get_csi_levels(self, schema):
-        """
-        Private method for estimate to get its own csi levels
+        Returns
+        -------
+        series
         """
 
-        levels_query = (
-            "select "
-            + f"array(select distinct replace(jsonb_object_keys({schema}), '{schema}', '')::int "
-            + "from line_items "
-            + f"where estimate = '{self.estimate_id}')"
+        if name in self.facts.columns:
+            return self.facts[name]
+        prefix, _, part = name.rpartition("_")
+        if (part not in ["code", "desc"]) or (prefix not in self.keys):
+            raise KeyError(f"{name} is not a column of these lines")
+        values = self.dimensions.decode(
+            self.keys[prefix], self.facts[f"{prefix}_key"], part
         )
-        return eval(self.query(levels_query)[0]["array"])
+        return pd.Series(values, index=self.facts.index, name=name)
 
-    def describe_csi_sorts(
-        self, df=None, schemas: list = ["mf", "uf"], levels: list = None
-    ):
+    def materialize(self, columns: list = None):
         """
-        Method to add the descriptions for each csi code (masterformat and uniformat) to the lines dataframe
-
-            Uses an internal function to build a sql query, which is then executed using the query method
+        Method to build the wide view of the lines
 
         Parameters
         ----------
-        df : dataframe, default: None
-        schemas : list of strings, default: ['mf','uf']
-            Must be either 'mf', 'uf', or both
-        levels : list of integers, default: None
-            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+        columns : list of strings, default: None
+            Specify columns to return if you like. Otherwise, every column of the wide view is returned
 
         Returns
         -------
         dataframe
+        """
 
-        Examples
-        --------
+        columns = self.columns if columns is None else columns
+        return pd.DataFrame({c: self.column(c) for c in columns}, index=self.facts.index)
+
+
+def _get_estimate_lines(db, estimate_id, add_cols, where=""):
+    """
+    Private function for Estimate and Portfolio to fetch the base columns of an estimate's lines, optionally narrowed by sql appended to the where clause
+    """
+
+    update = {
+        "__ADD_COLS__": "\n".join(map(lambda x: f"    ,{x}", add_cols)),
+        "__ESTIMATE_ID__": estimate_id,
+    }
+    with open("./queries/base_estimate_lines.sql", "r") as q:
+        query = q.read()
+        for i, j in update.items():
+            query = query.replace(i, j)
+    df = db.query(query=query + where, df=True)
+    cols = [
+        "id",
+        "name",
+        "quantity",
+        "uom",
+        "total_uc",
+        "mf1_code",
+        "mf2_code",
+        "mf3_code",
+        "uf1_code",
+        "uf2_code",
+        "uf3_code",
+    ] + add_cols
+    if df.empty:
+        return pd.DataFrame(columns=cols)
+    return df[cols]
+
+
+def _loaded_lines(source):
+    """
+    Private function for Estimate and UPC to return their lines, or explain why they are missing
+    """
+
+    if source.lines is None:
+        method = (
+            "expand_estimate_lines_chunked"
+            if isinstance(source, Estimate)
+            else "expand_upc_lines_chunked"
+        )
+        raise ValueError(
+            f"Lines were not loaded because load_lines=False; create the {type(source).__name__} "
+            + f"with load_lines=True, or use {method}"
+        )
+    return source.lines
+
+
+def _star_facts(lines, df_cs, csi_levels, sorts, dimensions):
+    """
+    Private function to encode lines and their custom sort rows into a fact frame of integer keys
+
+        Returns the facts, the keys mapping and the wide column order that StarLines expects
+    """
+
+    facts = lines.copy()
+    columns = list(facts.columns)
+    keys = {}
+    for schema, schema_levels in csi_levels.items():
+        for n in schema_levels:
+            name = f"{schema}{n}"
+            key = dimensions.encode(name, facts[f"{name}_code"])
+            facts.insert(facts.columns.get_loc(f"{name}_code"), f"{name}_key", key)
+            facts = facts.drop(columns=f"{name}_code")
+            columns.insert(columns.index(f"{name}_code") + 1, f"{name}_desc")
+            keys[name] = name
+    if df_cs.empty:
+        df_cs = pd.DataFrame(columns=["id", "code_name", "code", "description"])
+    sorts = sorts if sorts else df_cs["code_name"].drop_duplicates().to_list()
+    ids = pd.Index(facts["id"])
+    for sort in sorts:
+        df_cs_l = df_cs.loc[
+            df_cs["code_name"] == sort, ["id", "code", "description"]
+        ].drop_duplicates("id")
+        sort_keys = dimensions.encode(sort, df_cs_l["code"], df_cs_l["description"])
+        pos = ids.get_indexer(df_cs_l["id"])
+        found = pos >= 0
+        key = np.full(len(facts), -1, dtype="int32")
+        key[pos[found]] = sort_keys[found]
+        facts[f"{sort}_key"] = key
+        columns += [f"{sort}_code", f"{sort}_desc"]
+        keys[sort] = sort
+    return facts, keys, columns
+
+
+def _star_lines(source, sorts_query, schemas, levels, sorts, dimensions):
+    """
+    Private function for Estimate and UPC to encode their lines into StarLines
+    """
+
+    _check_csi_args(schemas, levels)
+    dimensions = Dimensions() if dimensions is None else dimensions
+    lines = _loaded_lines(source)
+    csi_levels = {}
+    for schema in schemas:
+        schema_levels = levels
+        if schema_levels is None:
+            schema_levels = source.mf_levels if schema == "mf" else source.uf_levels
+        schema_levels = [n for n in schema_levels if f"{schema}{n}_code" in lines.columns]
+        dimensions.load_csi(source, schema, schema_levels)
+        csi_levels[schema] = schema_levels
+    df_cs = source.query(query=sorts_query, df=True)
+    facts, keys, columns = _star_facts(lines, df_cs, csi_levels, sorts, dimensions)
+    return StarLines(facts, dimensions, keys, columns)
+
+
+# -----------------------------------------------------------------------
+# Chunked expansion
+
+
+def _expand_chunked(source, conj, alias, sorts_query, schemas, levels, sorts, chunk_limit):
+    """
+    Private generator for Estimate and UPC to expand their lines in batches of ids, fetching only the custom sort rows of each batch
+    """
+
+    if sorts is None:
+        names = source.query(
+            "select code_name from (select code_name, row_number() over () rn "
+            + f"from ({sorts_query.replace('__FILTER__', '')}) s) r "
+            + "group by code_name order by min(rn)"
+        )
+        sorts = [i["code_name"] for i in names]
+    csi, last = None, None
+    while True:
+        keyset = "" if last is None else f" {conj} {alias}.id > '{last}'"
+        df = source._get_lines(
+            f"\n{keyset} order by {alias}.id asc limit {chunk_limit}"
+        )
+        if df.empty:
+            break
+        last = df["id"].iloc[-1]
+        if csi is None:
+            csi = {}
+            for schema in schemas:
+                schema_levels = levels
+                if schema_levels is None:
+                    schema_levels = (
+                        source.mf_levels if schema == "mf" else source.uf_levels
+                    )
+                schema_levels = [
+                    n for n in schema_levels if f"{schema}{n}_code" in df.columns
+                ]
+                if schema_levels:
+                    query = _unpack_csi_json(schema, schema_levels)
+                    csi[schema] = (schema_levels, source.query(query=query, df=True))
+        n_lines = len(df)
+        for schema, (schema_levels, df_csi) in csi.items():
+            df = _merge_csi(df, df_csi, schema, schema_levels)
+        ids = ", ".join([f"'{i}'" for i in df["id"].drop_duplicates()])
+        df_cs = source.query(
+            query=sorts_query.replace("__FILTER__", f"\t{conj} t.id in ({ids})"),
+            df=True,
+        )
+        if df_cs.empty:
+            df_cs = pd.DataFrame(columns=["id", "code_name", "code", "description"])
+        yield _merge_custom_sorts(df, df_cs, sorts)
+        if n_lines < chunk_limit:
+            break
+
+
+def _drain_chunks(chunks, sink):
+    """
+    Private function to pass each expanded chunk to a callable sink, or append it to a csv file when sink is a path
+    """
+
+    rows = 0
+    for chunk in chunks:
+        if callable(sink):
+            sink(chunk)
+        else:
+            chunk.to_csv(sink, mode="a" if rows else "w", header=not rows, index=False)
+        rows += len(chunk)
+    return rows
+
+
+# -----------------------------------------------------------------------
+# Estimate class
+
+
+class Estimate(Database):
+    """
+    Estimate instance for a Database.
+
+    Data structure also includes estimate lines, and uf and mf levels
+
+    Parameters
+    ----------
+    estimate_id : string
+
+        Must exist in Database.
+
+    add_cols : list, default: []
+
+        Additional columns to return from the line_items table.
+
+    load_lines : bool, default: True
+
+        Set to False to skip loading lines, e.g. for estimates only expanded with expand_estimate_lines_chunked.
+
+    Attributes
+    ----------
+    estimate_id : string (uuid)
+    add_cols : list, default: []
+    estimate_name : string
+    lines : dataframe of the base columns from the line_items table, or None when load_lines is False
+    expanded_lines : dataframe from the line_items table including expanded sorts resulting from the expand_estimate_lines method
+    star_lines : StarLines of the line_items table resulting from the star_estimate_lines method
+    uf_levels : list of integers - uniformat levels that exist within the estimate
+    mf_levels : list of integers - masterformat levels that exist within the estimate
+
+    Examples
+    --------
+    Instatiating an estimate and inspecting its uf_levels.
+
+    >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
+    >>> display(est.uf_levels)
+       {1, 2, 3, 4}
+    """
+
+    def __init__(self, estimate_id, add_cols=[], load_lines=True):
+        super().__init__()
+        self.estimate_id = estimate_id
+        self.add_cols = add_cols
+        self.estimate_name = self.query(
+            f"select name from estimates where id = '{self.estimate_id}'"
+        )[0]["name"]
+        self.lines = self._get_lines() if load_lines else None
+        self.expanded_lines = None
+        self.star_lines = None
+        self.uf_levels = self._get_csi_levels("uf")
+        self.mf_levels = self._get_csi_levels("mf")
+
+    def _get_lines(self, where: str = ""):
+        """
+        Private method for estimate to get its own lines, optionally narrowed by sql appended to the where clause
+        """
+
+        return _get_estimate_lines(self, self.estimate_id, self.add_cols, where)
+
+    def _get_csi_levels(self, schema):
+        """
+        Private method for estimate to get its own csi levels
+        """
+
+        levels_query = (
+            "select "
+            + f"array(select distinct replace(jsonb_object_keys({schema}), '{schema}', '')::int "
+            + "from line_items "
+            + f"where estimate = '{self.estimate_id}')"
+        )
+        return eval(self.query(levels_query)[0]["array"])
+
+    def describe_csi_sorts(
+        self, df=None, schemas: list = ["mf", "uf"], levels: list = None
+    ):
+        """
+        Method to add the descriptions for each csi code (masterformat and uniformat) to the lines dataframe
+
+            Uses an internal function to build a sql query, which is then executed using the query method
+
+        Parameters
+        ----------
+        df : dataframe, default: None
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+
+        Returns
+        -------
+        dataframe
+
+        Examples
+        --------
         Retrive descriptions for uniformat level 3.
 
         >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
@@ -392,48 +1170,15 @@ class Estimate(Database):
         +----+-------------------------------------------------+------------+-------+------------+--------------------+
         """
 
-        def unpack_csi_json(schema, levels):
-            root = "jsonb_array_elements(value)"
-            elems = []
-            for level in levels:
-                if level == 1:
-                    elem = root
-                else:
-                    elem = (
-                        "jsonb_array_elements(" * (level - 1)
-                        + root
-                        + " ->'children')" * (level - 1)
-                    )
-                elems.append(f"{elem} ->> 'code' {schema}{level}_code")
-                elems.append(f"{elem} ->> 'description' {schema}{level}_desc")
-            return (
-                "select\n   "
-                + "".join(map(lambda x: f"{x}\n  ,", elems[:-1]))
-                + elems[-1]
-                + f"\nfrom setup s\nwhere key = 'sort_codes:{schema}'"
-            )
-
-        if any([i not in ["mf", "uf"] for i in schemas]) or (type(schemas) != list):
-            raise ValueError(
-                "Schema must be type list, and may contain mf, uf, or both"
-            )
-        if all([(type(levels) != list), levels is not None]):
-            raise ValueError("Levels must be type list (or None to use all levels)")
-        df = self.lines if df is None else df
-        cols = list(df.columns)
+        _check_csi_args(schemas, levels)
+        df = _loaded_lines(self) if df is None else df
         for schema in schemas:
             if levels is None:
                 levels = self.mf_levels if schema == "mf" else self.uf_levels
-            query = unpack_csi_json(schema, levels)
+            query = _unpack_csi_json(schema, levels)
             df_csi = self.query(query=query, df=True)
-            for n in levels:
-                df_csi_l = df_csi[
-                    [f"{schema}{n}_code", f"{schema}{n}_desc"]
-                ].drop_duplicates()
-                df = df.merge(df_csi_l, on=f"{schema}{n}_code", how="left")
-                idx = cols.index(f"{schema}{n}_code")
-                cols.insert(idx + 1, f"{schema}{n}_desc")
-        return df[cols]
+            df = _merge_csi(df, df_csi, schema, levels)
+        return df
 
     def get_custom_sorts(self, df=None, sorts=None):
         """
@@ -469,22 +1214,16 @@ class Estimate(Database):
         |  4 | Subcontract - Exterior Insulation & Finish System |          1 | ls    |               7.24 | Exterior Insulation & Finish Systems |
         +----+---------------------------------------------------+------------+-------+--------------------+--------------------------------------+
         """
+        df = _loaded_lines(self) if df is None else df
         with open("./queries/sorts_estimate.sql", "r") as q:
             df_cs = self.query(
-                query=q.read().replace("__ESTIMATE_ID__", str(self.estimate_id)),
+                query=q.read()
+                .replace("__ESTIMATE_ID__", str(self.estimate_id))
+                .replace("__FILTER__", ""),
                 df=True,
             )
         sorts = sorts if sorts else df_cs["code_name"].drop_duplicates().to_list()
-        df = self.lines if df is None else df
-        cols = list(df.columns)
-        for sort in sorts:
-            df_cs_l = df_cs.loc[
-                df_cs["code_name"] == sort, ["id", "code", "description"]
-            ].drop_duplicates()
-            df_cs_l.columns = ["id", f"{sort}_code", f"{sort}_desc"]
-            df = df.merge(df_cs_l, on="id", how="left")
-            cols += [f"{sort}_code", f"{sort}_desc"]
-        return df[cols]
+        return _merge_custom_sorts(df, df_cs, sorts)
 
     def expand_estimate_lines(
         self, schemas: list = ["mf", "uf"], levels: list = None, sorts=None
@@ -529,6 +1268,106 @@ class Estimate(Database):
         self.expanded_lines = self.get_custom_sorts(df=df, sorts=sorts)
         return self.expanded_lines
 
+    def expand_estimate_lines_chunked(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        chunk_limit: int = 1000,
+        sink=None,
+    ):
+        """
+        Method to expand the estimate lines in bounded batches, so that peak memory does not grow with the size of the estimate
+
+            Each batch of lines is fetched by keyset on id, then only the custom sort rows for those ids are fetched and merged.
+            Does not use the lines attribute, so it also works on an Estimate created with load_lines=False
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all sorts used in the estimate are returned
+        chunk_limit : int, default: 1000
+            Number of lines expanded per batch
+        sink : callable | string, default: None
+            Called with each expanded batch, or a path to a csv file the batches are written to. Otherwise, a generator of batches is returned
+
+        Returns
+        -------
+        generator of dataframes | int - number of lines passed to sink
+
+        Examples
+        --------
+        Stream a large estimate to csv.
+
+        >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de', load_lines=False)
+        >>> est.expand_estimate_lines_chunked(schemas=['uf',], sorts=['Bid Package',], sink='expanded_lines.csv')
+           48210
+        """
+        _check_csi_args(schemas, levels)
+        with open("./queries/sorts_estimate.sql", "r") as q:
+            sorts_query = q.read().replace("__ESTIMATE_ID__", str(self.estimate_id))
+        chunks = _expand_chunked(
+            self, "and", "l", sorts_query, schemas, levels, sorts, chunk_limit
+        )
+        return chunks if sink is None else _drain_chunks(chunks, sink)
+
+    def star_estimate_lines(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        dimensions=None,
+    ):
+        """
+        Method to represent the expanded lines as a star schema: a narrow fact frame of line measures and integer keys, plus shared dimension tables
+
+            Uses the same queries as expand_estimate_lines, but each csi code and custom sort is stored once in dimensions rather than once per line
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all available sorts are returned
+        dimensions : Dimensions, default: None
+            Pass the Dimensions of another estimate to share its dimension tables. Otherwise, new ones are created
+
+        Returns
+        -------
+        StarLines, stored in attribute: star_lines
+
+        Examples
+        --------
+        Retrive the fact frame for uniformat level 3 and Bid Package, and materialize it.
+
+        >>> est = ediphi.Estimate(estimate_id='b5790ff4-1edb-49cc-a529-23d4401e24de')
+        >>> star = est.star_estimate_lines(schemas=['uf',], levels=[3,], sorts=['Bid Package',])
+        >>> df = star.materialize(['name', 'uf3_code', 'uf3_desc', 'Bid Package_code', 'Bid Package_desc'])
+        >>> display(df.head(2))
+        +----+-------------------------------------------------+------------+--------------------+--------------------+--------------------------+
+        |    | name                                            | uf3_code   | uf3_desc           |   Bid Package_code | Bid Package_desc         |
+        |----+-------------------------------------------------+------------+--------------------+--------------------+--------------------------|
+        |  0 | Concrete Misc Wall - 10" Two-Sided              | B1010      | Floor Construction |               3.3  | Cast-In-Place Concrete   |
+        |  1 | Wood Wall Paneling on Cleats - Premium Material | C2010      | Wall Finishes      |               9.2  | Drywall                  |
+        +----+-------------------------------------------------+------------+--------------------+--------------------+--------------------------+
+        """
+        with open("./queries/sorts_estimate.sql", "r") as q:
+            sorts_query = (
+                q.read()
+                .replace("__ESTIMATE_ID__", str(self.estimate_id))
+                .replace("__FILTER__", "")
+            )
+        self.star_lines = _star_lines(
+            self, sorts_query, schemas, levels, sorts, dimensions
+        )
+        return self.star_lines
+
 
 # -----------------------------------------------------------------------
 # UPC class
@@ -546,11 +1385,16 @@ class UPC(Database):
 
         Additional columns to return from the line_items table.
 
+    load_lines : bool, default: True
+
+        Set to False to skip loading lines, e.g. for a upc only expanded with expand_upc_lines_chunked.
+
     Attributes
     ----------
     add_cols : list, default: []
-    lines : dataframe of the base columns from the line_items table
+    lines : dataframe of the base columns from the line_items table, or None when load_lines is False
     expanded_lines : dataframe from the line_items table including expanded sorts resulting from the expand_estimate_lines method
+    star_lines : StarLines of the products table resulting from the star_upc_lines method
     uf_levels : list of integers - uniformat levels that exist within the estimate
     mf_levels : list of integers - masterformat levels that exist within the estimate
 
@@ -563,17 +1407,18 @@ class UPC(Database):
        {1, 2, 3}
     """
 
-    def __init__(self, add_cols=[]):
+    def __init__(self, add_cols=[], load_lines=True):
         super().__init__()
         self.add_cols = add_cols
-        self.lines = self._get_lines()
+        self.lines = self._get_lines() if load_lines else None
         self.expanded_lines = None
+        self.star_lines = None
         self.uf_levels = self._get_csi_levels("uf")
         self.mf_levels = self._get_csi_levels("mf")
 
-    def _get_lines(self):
+    def _get_lines(self, where: str = ""):
         """
-        Private method for upc to get its own lines
+        Private method for upc to get its own lines, optionally narrowed by a where clause appended to the query
         """
 
         update = {"__ADD_COLS__": "\n".join(map(lambda x: f"    ,{x}", self.add_cols))}
@@ -581,7 +1426,7 @@ class UPC(Database):
             query = q.read()
             for i, j in update.items():
                 query = query.replace(i, j)
-        df = self.query(query=query, df=True)
+        df = self.query(query=query + where, df=True)
         cols = [
             "id",
             "name",
@@ -593,6 +1438,8 @@ class UPC(Database):
             "uf2_code",
             "uf3_code",
         ] + self.add_cols
+        if df.empty:
+            return pd.DataFrame(columns=cols)
         return df[cols]
 
     def _get_csi_levels(self, schema):
@@ -646,48 +1493,15 @@ class UPC(Database):
         +----+---------------------------------------+-------+------------+-----------------------------+
         """
 
-        def unpack_csi_json(schema, levels):
-            root = "jsonb_array_elements(value)"
-            elems = []
-            for level in levels:
-                if level == 1:
-                    elem = root
-                else:
-                    elem = (
-                        "jsonb_array_elements(" * (level - 1)
-                        + root
-                        + " ->'children')" * (level - 1)
-                    )
-                elems.append(f"{elem} ->> 'code' {schema}{level}_code")
-                elems.append(f"{elem} ->> 'description' {schema}{level}_desc")
-            return (
-                "select\n   "
-                + "".join(map(lambda x: f"{x}\n  ,", elems[:-1]))
-                + elems[-1]
-                + f"\nfrom setup s\nwhere key = 'sort_codes:{schema}'"
-            )
-
-        if any([i not in ["mf", "uf"] for i in schemas]) or (type(schemas) != list):
-            raise ValueError(
-                "Schema must be type list, and may contain mf, uf, or both"
-            )
-        if all([(type(levels) != list), levels is not None]):
-            raise ValueError("Levels must be type list (or None to use all levels)")
-        df = self.lines if df is None else df
-        cols = list(df.columns)
+        _check_csi_args(schemas, levels)
+        df = _loaded_lines(self) if df is None else df
         for schema in schemas:
             if levels is None:
                 levels = self.mf_levels if schema == "mf" else self.uf_levels
-            query = unpack_csi_json(schema, levels)
+            query = _unpack_csi_json(schema, levels)
             df_csi = self.query(query=query, df=True)
-            for n in levels:
-                df_csi_l = df_csi[
-                    [f"{schema}{n}_code", f"{schema}{n}_desc"]
-                ].drop_duplicates()
-                df = df.merge(df_csi_l, on=f"{schema}{n}_code", how="left")
-                idx = cols.index(f"{schema}{n}_code")
-                cols.insert(idx + 1, f"{schema}{n}_desc")
-        return df[cols]
+            df = _merge_csi(df, df_csi, schema, levels)
+        return df
 
     def get_custom_sorts(self, df=None, sorts=None):
         """
@@ -723,19 +1537,11 @@ class UPC(Database):
         |  4 | Project Executive (Precon)                              | hr    |               99   | Preconstruction                          |
         +----+---------------------------------------------------------+-------+--------------------+------------------------------------------+
         """
+        df = _loaded_lines(self) if df is None else df
         with open("./queries/sorts_upc.sql", "r") as q:
-            df_cs = self.query(query=q.read(), df=True)
+            df_cs = self.query(query=q.read().replace("__FILTER__", ""), df=True)
         sorts = sorts if sorts else df_cs["code_name"].drop_duplicates().to_list()
-        df = self.lines if df is None else df
-        cols = list(df.columns)
-        for sort in sorts:
-            df_cs_l = df_cs.loc[
-                df_cs["code_name"] == sort, ["id", "code", "description"]
-            ].drop_duplicates()
-            df_cs_l.columns = ["id", f"{sort}_code", f"{sort}_desc"]
-            df = df.merge(df_cs_l, on="id", how="left")
-            cols += [f"{sort}_code", f"{sort}_desc"]
-        return df[cols]
+        return _merge_custom_sorts(df, df_cs, sorts)
 
     def expand_upc_lines(
         self, schemas: list = ["mf", "uf"], levels: list = None, sorts=None
@@ -780,6 +1586,941 @@ class UPC(Database):
         self.expanded_lines = self.get_custom_sorts(df=df, sorts=sorts)
         return self.expanded_lines
 
+    def expand_upc_lines_chunked(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        chunk_limit: int = 1000,
+        sink=None,
+    ):
+        """
+        Method to expand the upc lines in bounded batches, so that peak memory does not grow with the size of the upc
+
+            Each batch of lines is fetched by keyset on id, then only the custom sort rows for those ids are fetched and merged.
+            Does not use the lines attribute, so it also works on a UPC created with load_lines=False
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all sorts used in the upc are returned
+        chunk_limit : int, default: 1000
+            Number of lines expanded per batch
+        sink : callable | string, default: None
+            Called with each expanded batch, or a path to a csv file the batches are written to. Otherwise, a generator of batches is returned
+
+        Returns
+        -------
+        generator of dataframes | int - number of lines passed to sink
+
+        Examples
+        --------
+        Iterate over the upc in batches.
+
+        >>> upc = ediphi.UPC(load_lines=False)
+        >>> for df in upc.expand_upc_lines_chunked(schemas=['uf',], levels=[3,], chunk_limit=500):
+        ...     display(df.shape)
+           (500, 12)
+        """
+        _check_csi_args(schemas, levels)
+        with open("./queries/sorts_upc.sql", "r") as q:
+            sorts_query = q.read()
+        chunks = _expand_chunked(
+            self, "where", "p", sorts_query, schemas, levels, sorts, chunk_limit
+        )
+        return chunks if sink is None else _drain_chunks(chunks, sink)
+
+    def star_upc_lines(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        dimensions=None,
+    ):
+        """
+        Method to represent the expanded lines as a star schema: a narrow fact frame of line measures and integer keys, plus shared dimension tables
+
+            Uses the same queries as expand_upc_lines, but each csi code and custom sort is stored once in dimensions rather than once per line
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, all available levels are returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all available sorts are returned
+        dimensions : Dimensions, default: None
+            Pass the Dimensions of an estimate to share its dimension tables. Otherwise, new ones are created
+
+        Returns
+        -------
+        StarLines, stored in attribute: star_lines
+
+        Examples
+        --------
+        Retrive the fact frame for uniformat level 3 and Bid Package, and materialize one column.
+
+        >>> upc = ediphi.UPC()
+        >>> star = upc.star_upc_lines(schemas=['uf',], levels=[3,], sorts=['Bid Package',])
+        >>> star.column('Bid Package_desc').head(2)
+        0           Preconstruction
+        1    Cast-In-Place Concrete
+        Name: Bid Package_desc, dtype: object
+        """
+        with open("./queries/sorts_upc.sql", "r") as q:
+            sorts_query = q.read().replace("__FILTER__", "")
+        self.star_lines = _star_lines(
+            self, sorts_query, schemas, levels, sorts, dimensions
+        )
+        return self.star_lines
+
+
+# -----------------------------------------------------------------------
+# Catalog class
+
+
+class Catalog(UPC):
+    """
+    Indexed catalog of the UPC for a Database.
+
+    Loads the UPC once, then answers lookups from in-memory indexes rather than filtering the lines dataframe.
+    Hash indexes cover product id, uom, the uf and mf codes, and every custom sort code. An inverted index of name tokens supports keyword and prefix search.
+    Soft-deleted products are left out. The refresh method pulls only the products updated or deleted since the last load.
+
+    Parameters
+    ----------
+    add_cols : list, default: []
+
+        Additional columns to return from the products table. updated_at is always included.
+
+    Attributes
+    ----------
+    products : dict - keys are product id, values are product records
+    indexes : dict - keys are column names (uom, uf1_code ... mf3_code), values are dicts of value to a set of product ids
+    sort_index : dict - keys are sort names, values are dicts of code to a set of product ids
+    token_index : dict - keys are name tokens, values are sets of product ids
+    updated_at : string - latest updated_at loaded into the catalog, used by refresh
+
+    Examples
+    --------
+    Searching the catalog by keyword, then by uniformat code.
+
+    >>> catalog = ediphi.Catalog()
+    >>> df = catalog.search('scissor lift', df=True)
+    >>> display(df[['name', 'uom', 'uf3_code']])
+    +----+------------------------------+-------+------------+
+    |    | name                         | uom   | uf3_code   |
+    |----+------------------------------+-------+------------|
+    |  0 | Scissor Lift - 25-26' Narrow | mo    | Z1050      |
+    +----+------------------------------+-------+------------+
+    >>> len(catalog.lookup('uf3_code', 'B1010'))
+       112
+    """
+
+    def __init__(self, add_cols=[]):
+        add_cols = add_cols if "updated_at" in add_cols else add_cols + ["updated_at"]
+        super().__init__(add_cols=add_cols, load_lines=False)
+        self.lines = self._get_lines("\nwhere p.deleted_at is null")
+        self.products = {}
+        self.indexes = {
+            i: {}
+            for i in [
+                "uom",
+                "mf1_code",
+                "mf2_code",
+                "mf3_code",
+                "uf1_code",
+                "uf2_code",
+                "uf3_code",
+            ]
+        }
+        self.sort_index = {}
+        self.token_index = {}
+        self.updated_at = None
+        self._tokens = []
+        self._product_sorts = {}
+        self._boundary_ids = set()
+        with open("./queries/sorts_upc.sql", "r") as q:
+            df_cs = self.query(
+                query=q.read().replace("__FILTER__", "\twhere t.deleted_at is null"),
+                df=True,
+            )
+        self._index(self.lines, df_cs)
+        self._advance(self.lines)
+
+    def _index(self, lines, df_cs):
+        """
+        Private method for Catalog to add products, and their custom sort codes, to its indexes
+        """
+
+        self._unindex(set(lines["id"]) & self.products.keys())
+        for record in lines.to_dict("records"):
+            product_id = record["id"]
+            self.products[product_id] = record
+            for col, index in self.indexes.items():
+                if pd.notna(record[col]):
+                    index.setdefault(record[col], set()).add(product_id)
+            for token in _tokenize(record["name"]):
+                self.token_index.setdefault(token, set()).add(product_id)
+        if df_cs.empty:
+            df_cs = pd.DataFrame(columns=["id", "code_name", "code"])
+        df_cs = df_cs[df_cs["id"].isin(lines["id"]) & df_cs["code"].notna()]
+        for product_id, sort, code in df_cs[["id", "code_name", "code"]].itertuples(
+            index=False
+        ):
+            self._product_sorts.setdefault(product_id, {})[sort] = code
+            self.sort_index.setdefault(sort, {}).setdefault(code, set()).add(product_id)
+        self._tokens = sorted(self.token_index)
+
+    def _advance(self, changes):
+        """
+        Private method for Catalog to move its updated_at high-water mark, remembering the ids updated exactly at the mark
+        """
+
+        updated_at = pd.to_datetime(changes["updated_at"], utc=True, format="ISO8601")
+        latest = updated_at.max()
+        if pd.isna(latest):
+            return
+        ids = set(changes.loc[(updated_at == latest).to_numpy(), "id"])
+        if (self.updated_at is None) or (latest > pd.Timestamp(self.updated_at)):
+            self.updated_at = latest.isoformat()
+            self._boundary_ids = ids
+        elif latest == pd.Timestamp(self.updated_at):
+            self._boundary_ids |= ids
+
+    def _unchanged(self, changes):
+        """
+        Private method for Catalog to flag rows already loaded at the high-water mark, which refresh re-fetches because it filters on >=
+        """
+
+        if self.updated_at is None:
+            return pd.Series(False, index=changes.index)
+        updated_at = pd.to_datetime(changes["updated_at"], utc=True, format="ISO8601")
+        return (updated_at == pd.Timestamp(self.updated_at)) & changes["id"].isin(
+            self._boundary_ids
+        )
+
+    def _unindex(self, product_ids):
+        """
+        Private method for Catalog to remove products from its indexes, when they are deleted or before they are re-indexed
+        """
+
+        def discard(index, key, product_id):
+            ids = index.get(key)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del index[key]
+
+        for product_id in product_ids:
+            record = self.products.pop(product_id)
+            for col, index in self.indexes.items():
+                discard(index, record[col], product_id)
+            for token in _tokenize(record["name"]):
+                discard(self.token_index, token, product_id)
+            for sort, code in self._product_sorts.pop(product_id, {}).items():
+                discard(self.sort_index[sort], code, product_id)
+        self._tokens = sorted(self.token_index)
+
+    def _records(self, product_ids, df):
+        """
+        Private method for Catalog to return products as records or a dataframe
+        """
+
+        records = [self.products[i] for i in sorted(product_ids)]
+        if df:
+            return pd.DataFrame(records, columns=self.lines.columns)
+        else:
+            return records
+
+    def refresh(self):
+        """
+        Method to pull products updated or deleted since the catalog was last loaded, and re-index them
+
+            Uses the query method to execute base_upc.sql and sorts_upc.sql filtered on updated_at, skipping soft-deleted products.
+            Products whose deleted_at falls on or after the last load are removed from the catalog
+
+        Returns
+        -------
+        int - number of products added, updated or removed
+
+        Examples
+        --------
+        Keep a long-running catalog current. An unchanged catalog returns 0.
+
+        >>> catalog = ediphi.Catalog()
+        >>> catalog.refresh()
+           0
+        """
+
+        def since(alias, column="updated_at"):
+            if self.updated_at is None:
+                return ""
+            return f" and {alias}.{column} >= '{self.updated_at}'"
+
+        lines = self._get_lines(f"\nwhere p.deleted_at is null{since('p')}")
+        deleted = self.query(
+            "select p.id, p.deleted_at as updated_at from products p "
+            + f"where p.deleted_at is not null{since('p', 'deleted_at')}",
+            df=True,
+        )
+        if deleted.empty:
+            deleted = pd.DataFrame(columns=["id", "updated_at"])
+        lines = lines[~self._unchanged(lines)]
+        removed = set(deleted["id"]) & self.products.keys()
+        self._unindex(removed)
+        if not lines.empty:
+            with open("./queries/sorts_upc.sql", "r") as q:
+                df_cs = self.query(
+                    query=q.read().replace(
+                        "__FILTER__", f"\twhere t.deleted_at is null{since('t')}"
+                    ),
+                    df=True,
+                )
+            self._index(lines, df_cs)
+        self.lines = pd.concat(
+            [self.lines[~self.lines["id"].isin(set(lines["id"]) | removed)], lines],
+            ignore_index=True,
+        )
+        self._advance(pd.concat([lines[["id", "updated_at"]], deleted]))
+        return len(lines) + len(removed)
+
+    def get(self, product_id: str):
+        """
+        Method to fetch one product by id
+
+        Parameters
+        ----------
+        product_id : string (uuid)
+
+        Returns
+        -------
+        dict | None
+        """
+
+        return self.products.get(product_id)
+
+    def lookup(self, column: str, value, df: bool = False):
+        """
+        Method to fetch products by uom, or by uf or mf code
+
+        Parameters
+        ----------
+        column : string
+            Must be one of uom, uf1_code, uf2_code, uf3_code, mf1_code, mf2_code, mf3_code
+        value : string
+        df : bool, default: False
+            Set to True to return results as pandas dataframe
+
+        Returns
+        -------
+        list | dataframe
+        """
+
+        if column not in self.indexes:
+            raise ValueError(f"Column must be one of {', '.join(self.indexes)}")
+        return self._records(self.indexes[column].get(value, set()), df)
+
+    def lookup_sort(self, sort: str, code, df: bool = False):
+        """
+        Method to fetch products by custom sort code
+
+        Parameters
+        ----------
+        sort : string
+            name of the custom sort, e.g. Bid Package
+        code : string
+        df : bool, default: False
+            Set to True to return results as pandas dataframe
+
+        Returns
+        -------
+        list | dataframe
+        """
+
+        return self._records(self.sort_index.get(sort, {}).get(code, set()), df)
+
+    def search(self, text: str, prefix: bool = True, df: bool = False):
+        """
+        Method to fetch products whose name contains every token in text
+
+        Parameters
+        ----------
+        text : string
+            keywords, e.g. 'conc wall'
+        prefix : bool, default: True
+            Set to False to match whole tokens only
+        df : bool, default: False
+            Set to True to return results as pandas dataframe
+
+        Returns
+        -------
+        list | dataframe
+        """
+
+        product_ids = None
+        for token in _tokenize(text):
+            if prefix:
+                start = bisect.bisect_left(self._tokens, token)
+                end = bisect.bisect_left(self._tokens, token + "\uffff")
+                ids = set().union(
+                    *[self.token_index[i] for i in self._tokens[start:end]]
+                )
+            else:
+                ids = self.token_index.get(token, set())
+            product_ids = ids if product_ids is None else product_ids & ids
+            if not product_ids:
+                break
+        return self._records(product_ids or set(), df)
+
+
+# -----------------------------------------------------------------------
+# Benchmark class
+
+
+class Benchmark(Database):
+    """
+    Unit cost benchmark across many estimates in a Database.
+
+    Pulls the lines of every estimate in bulk, keeps them in a compact columnar dataframe (categorical codes, float measures),
+    and computes grouped unit cost statistics with vectorized numpy operations rather than one Estimate at a time.
+
+    Parameters
+    ----------
+    estimate_ids : list of strings
+
+        Must exist in Database.
+
+    batch_size : int, default: 50
+
+        Number of estimates fetched per query.
+
+    chunk_limit : int, default: 10_000
+
+        Rows fetched per page within a batch.
+
+    max_workers : int, default: 4
+
+        Number of batches fetched concurrently.
+
+    Attributes
+    ----------
+    estimate_ids : list of strings (uuid)
+    lines : dataframe of estimate, estimate_date, quantity, uom, total_uc and the uf and mf codes for every line
+
+    Examples
+    --------
+    Unit cost percentiles by uniformat level 3 and uom.
+
+    >>> bench = ediphi.Benchmark(estimate_ids=estimate_ids)
+    >>> df = bench.unit_costs(by=['uf3_code', 'uom'])
+    >>> display(df[['uf3_code', 'uom', 'lines', 'estimates', 'p50']].head(2))
+    +----+------------+-------+---------+-------------+--------+
+    |    | uf3_code   | uom   |   lines |   estimates |    p50 |
+    |----+------------+-------+---------+-------------+--------|
+    |  0 | A1010      | cy    |     412 |          61 | 612.5  |
+    |  1 | A1010      | sf    |     188 |          40 |  18.75 |
+    +----+------------+-------+---------+-------------+--------+
+    """
+
+    def __init__(self, estimate_ids, batch_size=50, chunk_limit=10_000, max_workers=4):
+        super().__init__()
+        self.estimate_ids = list(estimate_ids)
+        self.lines = self._get_lines(batch_size, chunk_limit, max_workers)
+
+    def _get_lines(self, batch_size, chunk_limit, max_workers):
+        """
+        Private method for Benchmark to page through the lines of its estimates and compact them
+        """
+
+        with open("./queries/benchmark_lines.sql", "r") as q:
+            base_query = q.read()
+        categories = [
+            "estimate",
+            "uom",
+            "uf1_code",
+            "uf2_code",
+            "uf3_code",
+            "mf1_code",
+            "mf2_code",
+            "mf3_code",
+        ]
+
+        def compact(res):
+            df = pd.DataFrame(res)
+            for col in categories:
+                df[col] = df[col].astype("category")
+            for col in ["quantity", "total_uc"]:
+                df[col] = pd.to_numeric(df[col], errors="coerce")
+            df["estimate_date"] = pd.to_datetime(
+                df["estimate_date"], utc=True, format="ISO8601"
+            )
+            return df.drop(columns="id")
+
+        def fetch(batch):
+            ids = ", ".join([f"'{i}'" for i in batch])
+            query = base_query.replace("__ESTIMATE_IDS__", ids)
+            pages, last = [], None
+            while True:
+                keyset = "" if last is None else f" and l.id > '{last}'"
+                res = self.query(f"{query}{keyset} order by l.id asc limit {chunk_limit}")
+                if len(res) == 0:
+                    break
+                last = res[-1]["id"]
+                pages.append(compact(res))
+                if len(res) < chunk_limit:
+                    break
+            return pages
+
+        batches = [
+            self.estimate_ids[i : i + batch_size]
+            for i in range(0, len(self.estimate_ids), batch_size)
+        ]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pages = [page for result in executor.map(fetch, batches) for page in result]
+        if not pages:
+            raise ValueError("No lines were found for the estimate_ids you entered")
+        for col in categories:
+            # an all-null page has empty object categories, which union_categoricals rejects beside str categories
+            found = [page[col].cat.categories for page in pages]
+            found = [i for i in found if len(i)] or found[:1]
+            union = found[0].append(found[1:]).unique()
+            for page in pages:
+                page[col] = page[col].cat.set_categories(union)
+        return pd.concat(pages, ignore_index=True)
+
+    def _valid(self, by):
+        """
+        Private method for Benchmark to select lines with a unit cost, a positive quantity and every grouping column
+        """
+
+        if any([i not in self.lines.columns for i in by]):
+            raise ValueError(f"By must be a list of columns from: {', '.join(self.lines.columns)}")
+        lines = self.lines
+        mask = (
+            lines["total_uc"].notna()
+            & (lines["quantity"] > 0)
+            & lines[by].notna().all(axis=1)
+        )
+        return lines.loc[mask]
+
+    @staticmethod
+    def _grouped_stats(lines, by, weighted):
+        """
+        Private method for Benchmark to compute group ids, keys, weights and weighted mean and std of total_uc
+        """
+
+        grouped = lines.groupby(by, observed=True, sort=True)
+        gid = grouped.ngroup().to_numpy()
+        keys = grouped.size().index.to_frame(index=False)
+        values = lines["total_uc"].to_numpy(dtype="float64")
+        weights = (
+            lines["quantity"].to_numpy(dtype="float64")
+            if weighted
+            else np.ones(len(values))
+        )
+        n = len(keys)
+        total = np.bincount(gid, weights=weights, minlength=n)
+        mean = np.bincount(gid, weights=weights * values, minlength=n) / total
+        var = np.bincount(gid, weights=weights * (values - mean[gid]) ** 2, minlength=n)
+        std = np.sqrt(var / total)
+        return gid, keys, values, weights, mean, std
+
+    @staticmethod
+    def _weighted_percentiles(gid, values, weights, percentiles):
+        """
+        Private method for Benchmark to compute lower weighted percentiles for every group at once
+
+            Lines are sorted by group then value, and the cumulative weight fraction within each group is offset by the group id,
+            so one searchsorted over the whole array finds every percentile of every group
+        """
+
+        if len(gid) == 0:
+            return np.empty((0, len(percentiles)))
+        order = np.lexsort((values, gid))
+        g, v, w = gid[order], values[order], weights[order]
+        cumw = pd.Series(w).groupby(g).cumsum().to_numpy()
+        starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+        ends = np.r_[starts[1:], len(g)]
+        totals = cumw[ends - 1]
+        key = g + cumw / np.repeat(totals, ends - starts)
+        targets = g[starts][:, None] + np.asarray(percentiles)[None, :] / 100
+        pos = np.searchsorted(key, targets.ravel(), side="left").reshape(targets.shape)
+        pos = np.clip(pos, starts[:, None], (ends - 1)[:, None])
+        return v[pos]
+
+    def unit_costs(
+        self,
+        by: list = ["uf3_code", "uom"],
+        percentiles: list = [10, 25, 50, 75, 90],
+        weighted: bool = True,
+    ):
+        """
+        Method to compute unit cost statistics for each group of lines
+
+        Parameters
+        ----------
+        by : list of strings, default: ['uf3_code', 'uom']
+            Columns of lines to group by, e.g. ['mf3_code', 'uom']
+        percentiles : list of numbers, default: [10, 25, 50, 75, 90]
+            Percentiles of total_uc to return, between 0 and 100
+        weighted : bool, default: True
+            Weight lines by quantity. Set to False to weight every line equally
+
+        Returns
+        -------
+        dataframe
+            one row per group with lines, estimates, quantity, mean, std and a p<n> column per percentile
+        """
+
+        lines = self._valid(by)
+        gid, keys, values, weights, mean, std = self._grouped_stats(lines, by, weighted)
+        n = len(keys)
+        keys["lines"] = np.bincount(gid, minlength=n)
+        keys["estimates"] = (
+            pd.DataFrame({"gid": gid, "estimate": lines["estimate"].cat.codes.to_numpy()})
+            .drop_duplicates()["gid"]
+            .value_counts()
+            .sort_index()
+            .to_numpy()
+        )
+        keys["quantity"] = np.bincount(
+            gid, weights=lines["quantity"].to_numpy(dtype="float64"), minlength=n
+        )
+        keys["mean"] = mean
+        keys["std"] = std
+        pct = self._weighted_percentiles(gid, values, weights, percentiles)
+        for i, p in enumerate(percentiles):
+            keys[f"p{p}"] = pct[:, i]
+        return keys
+
+    def outliers(
+        self, by: list = ["uf3_code", "uom"], threshold: float = 3.0, weighted: bool = True
+    ):
+        """
+        Method to flag lines whose unit cost is far from the mean of their group
+
+        Parameters
+        ----------
+        by : list of strings, default: ['uf3_code', 'uom']
+            Columns of lines to group by
+        threshold : float, default: 3.0
+            Absolute z-score above which a line is flagged
+        weighted : bool, default: True
+            Weight the group mean and std by quantity
+
+        Returns
+        -------
+        dataframe
+            the grouped lines with z_score and outlier columns added
+        """
+
+        lines = self._valid(by)
+        gid, keys, values, weights, mean, std = self._grouped_stats(lines, by, weighted)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = (values - mean[gid]) / std[gid]
+        lines = lines.assign(z_score=np.where(std[gid] > 0, z, 0.0))
+        lines["outlier"] = lines["z_score"].abs() > threshold
+        return lines
+
+    def trends(self, by: list = ["uf3_code", "uom"], freq: str = "Y", weighted: bool = True):
+        """
+        Method to compute the mean unit cost of each group per period of estimate date
+
+        Parameters
+        ----------
+        by : list of strings, default: ['uf3_code', 'uom']
+            Columns of lines to group by
+        freq : string, default: 'Y'
+            pandas period frequency, e.g. 'Q' or 'M'
+        weighted : bool, default: True
+            Weight the mean by quantity
+
+        Returns
+        -------
+        dataframe
+            one row per group and period with lines, mean and pct_change from the group's previous period
+        """
+
+        lines = self._valid(by)
+        lines = lines.assign(
+            period=lines["estimate_date"].dt.tz_convert(None).dt.to_period(freq)
+        )
+        gid, keys, values, weights, mean, std = self._grouped_stats(
+            lines, by + ["period"], weighted
+        )
+        keys["lines"] = np.bincount(gid, minlength=len(keys))
+        keys["mean"] = mean
+        keys["pct_change"] = keys.groupby(by, observed=True)["mean"].pct_change()
+        return keys
+
+
+# -----------------------------------------------------------------------
+# Portfolio class
+
+# state shared with every process pool worker by _init_expand_worker
+_worker_state = None
+
+
+def _init_expand_worker(state):
+    """
+    Private function to hand the shared csi tables or Dimensions to a process pool worker once, rather than with every task
+    """
+
+    global _worker_state
+    _worker_state = state
+
+
+def _decode_sort_rows(df_cs):
+    """
+    Private function to restore custom sort rows that were sent as categoricals to their original dtypes
+    """
+
+    return df_cs.astype(
+        {i: df_cs[i].cat.categories.dtype for i in ["code_name", "code", "description"]}
+    )
+
+
+def _expand_worker(task):
+    """
+    Private function for a process pool worker to expand the lines of one estimate, either wide or as star facts
+    """
+
+    lines, df_cs, sorts = task
+    df_cs = _decode_sort_rows(df_cs)
+    csi_levels = _worker_state["csi_levels"]
+    if _worker_state["dimensions"] is not None:
+        return _star_facts(lines, df_cs, csi_levels, sorts, _worker_state["dimensions"])
+    for schema, df_csi in _worker_state["csi"].items():
+        lines = _merge_csi(lines, df_csi, schema, csi_levels[schema])
+    sorts = sorts if sorts else df_cs["code_name"].drop_duplicates().to_list()
+    return _merge_custom_sorts(lines, df_cs, sorts)
+
+
+class Portfolio(Database):
+    """
+    Portfolio of estimates in a Database.
+
+    Downloads the lines and custom sorts of many estimates concurrently, then expands them in parallel across a process pool.
+    Workers receive the shared csi tables, or the shared Dimensions, once when they start. Each task carries only the narrow lines
+    and custom sort rows of one estimate, with the repeated sort strings sent as categoricals.
+
+    The expand method returns wide dataframes, which are pickled back from the workers in full. The star method returns
+    StarLines whose facts hold integer keys into one Dimensions, so far less data comes back from the workers.
+    A process pool only pays off with several cores and sizeable estimates; on one or two cores the start-up and
+    transfer costs can make it slower than expanding each Estimate in turn.
+
+    Parameters
+    ----------
+    estimate_ids : list of strings
+
+        Must exist in Database.
+
+    add_cols : list, default: []
+
+        Additional columns to return from the line_items table.
+
+    max_workers : int, default: 8
+
+        Number of estimates downloaded concurrently.
+
+    Attributes
+    ----------
+    estimate_ids : list of strings (uuid)
+    add_cols : list, default: []
+    lines : dict - keys are estimate_id, values are dataframes of the base columns from the line_items table
+    expanded_lines : dict - keys are estimate_id, values are dataframes resulting from the expand method
+    star_lines : dict - keys are estimate_id, values are StarLines resulting from the star method
+
+    Examples
+    --------
+    Expanding uniformat level 3 and Bid Package for every estimate on all cores.
+
+    >>> portfolio = ediphi.Portfolio(estimate_ids=estimate_ids)
+    >>> expanded = portfolio.expand(schemas=['uf',], levels=[3,], sorts=['Bid Package',])
+    >>> df = pd.concat(expanded, names=['estimate', None]).reset_index(level=0)
+    """
+
+    def __init__(self, estimate_ids, add_cols=[], max_workers=8):
+        super().__init__()
+        self.estimate_ids = list(estimate_ids)
+        self.add_cols = add_cols
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = list(executor.map(self._get_estimate, self.estimate_ids))
+        self.lines = {i: lines for i, (lines, _) in zip(self.estimate_ids, fetched)}
+        self._sorts = {i: df_cs for i, (_, df_cs) in zip(self.estimate_ids, fetched)}
+        self.expanded_lines = None
+        self.star_lines = None
+
+    def _get_estimate(self, estimate_id):
+        """
+        Private method for Portfolio to get the lines and custom sort rows of one estimate
+        """
+
+        lines = _get_estimate_lines(self, estimate_id, self.add_cols)
+        with open("./queries/sorts_estimate.sql", "r") as q:
+            query = (
+                q.read()
+                .replace("__ESTIMATE_ID__", estimate_id)
+                .replace("__FILTER__", "")
+            )
+        sort_cols = ["id", "code_name", "code", "description"]
+        df_cs = self.query(query=query, df=True)
+        df_cs = pd.DataFrame(columns=sort_cols) if df_cs.empty else df_cs[sort_cols]
+        return lines, df_cs.astype({i: "category" for i in sort_cols[1:]})
+
+    def _csi_levels(self, schemas, levels):
+        """
+        Private method for Portfolio to resolve the csi levels to expand for each schema
+        """
+
+        _check_csi_args(schemas, levels)
+        cols = list(self.lines[self.estimate_ids[0]].columns) if self.estimate_ids else []
+        csi_levels = {}
+        for schema in schemas:
+            schema_levels = levels
+            if schema_levels is None:
+                schema_levels = sorted(
+                    int(m.group(1))
+                    for m in [re.fullmatch(rf"{schema}(\d+)_code", c) for c in cols]
+                    if m
+                )
+            schema_levels = [n for n in schema_levels if f"{schema}{n}_code" in cols]
+            if schema_levels:
+                csi_levels[schema] = schema_levels
+        return csi_levels
+
+    def _map_estimates(self, state, sorts, processes, chunksize):
+        """
+        Private method for Portfolio to run _expand_worker over every estimate, returning results in the order of estimate_ids
+        """
+
+        tasks = ((self.lines[i], self._sorts[i], sorts) for i in self.estimate_ids)
+        with ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_expand_worker, initargs=(state,)
+        ) as executor:
+            return list(executor.map(_expand_worker, tasks, chunksize=chunksize))
+
+    def expand(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        processes: int = None,
+        chunksize: int = 1,
+    ):
+        """
+        Method to add the csi descriptions and custom sort codes and descriptions to the lines of every estimate, in parallel
+
+            Produces the same dataframe per estimate as expand_estimate_lines, using a process pool so that the pandas work runs on every core.
+            Each wide result is pickled back from its worker; use the star method to bring back integer keys instead
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, every level in the lines is returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all sorts used in each estimate are returned
+        processes : int, default: None
+            Number of worker processes. Otherwise, one per core
+        chunksize : int, default: 1
+            Number of estimates sent to a worker at a time. Raise it for many small estimates
+
+        Returns
+        -------
+        dict, stored in attribute: expanded_lines
+            keys are estimate_id in the order of estimate_ids, values are dataframes
+        """
+
+        csi_levels = self._csi_levels(schemas, levels)
+        csi = {
+            schema: self.query(query=_unpack_csi_json(schema, schema_levels), df=True)
+            for schema, schema_levels in csi_levels.items()
+        }
+        state = {"csi_levels": csi_levels, "csi": csi, "dimensions": None}
+        results = self._map_estimates(state, sorts, processes, chunksize)
+        self.expanded_lines = dict(zip(self.estimate_ids, results))
+        return self.expanded_lines
+
+    def star(
+        self,
+        schemas: list = ["mf", "uf"],
+        levels: list = None,
+        sorts=None,
+        dimensions=None,
+        processes: int = None,
+        chunksize: int = 1,
+    ):
+        """
+        Method to represent the lines of every estimate as StarLines sharing one Dimensions, encoding them in parallel
+
+            The parent loads every csi code and custom sort code of the portfolio into dimensions first, and sends it to each worker once.
+            Workers then only look keys up, so they agree on every key, and each returns a narrow fact frame of integer keys
+
+        Parameters
+        ----------
+        schemas : list of strings, default: ['mf','uf']
+            Must be either 'mf', 'uf', or both
+        levels : list of integers, default: None
+            Specify csi sort levels to return if you like. Otherwise, every level in the lines is returned
+        sorts : list of strings, default: None
+            Specify the names of custom sorts to return if you like. Otherwise, all sorts used in each estimate are returned
+        dimensions : Dimensions, default: None
+            Pass an existing Dimensions to share its dimension tables. Otherwise, new ones are created
+        processes : int, default: None
+            Number of worker processes. Otherwise, one per core
+        chunksize : int, default: 1
+            Number of estimates sent to a worker at a time. Raise it for many small estimates
+
+        Returns
+        -------
+        dict, stored in attribute: star_lines
+            keys are estimate_id in the order of estimate_ids, values are StarLines
+
+        Examples
+        --------
+        Encode every estimate, then materialize one of them.
+
+        >>> portfolio = ediphi.Portfolio(estimate_ids=estimate_ids)
+        >>> stars = portfolio.star(schemas=['uf',], levels=[3,], sorts=['Bid Package',])
+        >>> df = stars[estimate_ids[0]].materialize()
+        """
+
+        csi_levels = self._csi_levels(schemas, levels)
+        dimensions = Dimensions() if dimensions is None else dimensions
+        for schema, schema_levels in csi_levels.items():
+            dimensions.load_csi(self, schema, schema_levels)
+            for n in schema_levels:
+                codes = pd.concat(
+                    [self.lines[i][f"{schema}{n}_code"] for i in self.estimate_ids]
+                )
+                dimensions.encode(f"{schema}{n}", codes.drop_duplicates())
+        pairs = pd.concat(
+            [pd.DataFrame(columns=["code_name", "code", "description"])]
+            + [
+                _decode_sort_rows(self._sorts[i])[["code_name", "code", "description"]]
+                .drop_duplicates()
+                for i in self.estimate_ids
+            ]
+        ).drop_duplicates()
+        for sort in sorts if sorts else pairs["code_name"].dropna().drop_duplicates():
+            pairs_l = pairs[pairs["code_name"] == sort]
+            dimensions.encode(sort, pairs_l["code"], pairs_l["description"])
+        state = {"csi_levels": csi_levels, "csi": None, "dimensions": dimensions}
+        results = self._map_estimates(state, sorts, processes, chunksize)
+        self.star_lines = {
+            i: StarLines(facts, dimensions, keys, columns)
+            for i, (facts, keys, columns) in zip(self.estimate_ids, results)
+        }
+        return self.star_lines
+
 
 # -----------------------------------------------------------------------
 # Table class